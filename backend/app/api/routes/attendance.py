@@ -3,7 +3,7 @@ from typing import List, Dict, Any
 from app.database import query, create, delete
 from app.services.attendance import get_attendance_records, delete_attendance_record, get_employee_shift_info
 from app.utils.processing import process_image_in_process,process_attendance_for_employee
-from app.dependencies import get_process_pool, get_pending_futures, get_client_tasks, get_queues, get_face_recognition
+from app.dependencies import get_process_pool, get_pending_futures, get_client_tasks, get_queues, get_face_recognition, invalidate_employee_cache
 from app.utils.websocket import broadcast_attendance_update
 from app.utils.time_utils import get_local_time
 import asyncio
@@ -119,7 +119,7 @@ async def mark_attendance(
 
         # Find matches for all detected faces
         matches = face_recognition.find_matches_for_embeddings(
-            face_embeddings, employees)
+            face_embeddings.embeddings, employees)
 
         if not matches:
             raise HTTPException(
@@ -356,7 +356,7 @@ async def register_employee(
                 status_code=400, detail="No face detected in image")
 
         # Convert embedding to string for storage
-        embedding_str = ",".join(map(str, face_embeddings[0]))
+        embedding_str = face_recognition.embedding_to_str(face_embeddings.embeddings[0])
 
         # Create employee record
         employee = Employee()
@@ -376,6 +376,7 @@ async def register_employee(
             "email": email,
             "is_admin": is_admin
         })
+        invalidate_employee_cache()
 
         return {
             "message": "Employee registered successfully",
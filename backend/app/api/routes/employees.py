@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Form
 from typing import List, Dict, Any, Optional
 from app.services.employee import get_employees, delete_employee
-from app.dependencies import get_face_recognition
+from app.dependencies import get_face_recognition, invalidate_employee_cache
 from app.utils.websocket import broadcast_attendance_update
 from app.utils.time_utils import get_local_time
 from app.dependencies import get_queues
@@ -76,6 +76,7 @@ async def update_employee_route(
         }
         
         result = Employee().update(employee_id, update_data)
+        invalidate_employee_cache()
         return {
             "message": "Employee details updated successfully",
             "employee": result
@@ -99,6 +100,7 @@ def delete_employee_route(employee_id: str):
         else:
             # Delete by employee_id
             result = delete_employee(employee_id=employee_id)
+        invalidate_employee_cache()
         
         # Get the identifier for broadcasting - use the one that was in the result message
         broadcast_id = employee_id
@@ -182,6 +184,7 @@ async def register_employee(
                 "objectId": shift_id
             }
         })
+        invalidate_employee_cache()
 
         # Broadcast user registration
         attendance_update = {
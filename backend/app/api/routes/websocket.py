@@ -18,12 +18,12 @@ from app.dependencies import (
     get_active_connections,
     get_face_recognition,
     get_employee_cache,
-    get_cached_employees
+    get_cached_employees,
+    get_employee_matrix_handle,
+    invalidate_employee_cache
 )
 from app.utils.websocket import (
     ping_client, 
-    process_queue, 
-    process_websocket_responses, 
     broadcast_attendance_update,
     handle_future_completion
 )
@@ -38,6 +38,8 @@ router = APIRouter()
 
 @router.websocket("/ws/attendance")
 async def websocket_endpoint(websocket: WebSocket):
+    # No TCP_NODELAY setup needed here: asyncio already disables Nagle on the
+    # TCP transports uvicorn accepts, and the ASGI scope doesn't expose the socket
     await websocket.accept()
     
     # Generate unique client ID
@@ -85,11 +87,11 @@ async def websocket_endpoint(websocket: WebSocket):
                 })
 
             elif data.get("type") == "get_employees":
-                # Run employee query in thread pool
-                def fetch_employees():
+                # Employee cache refreshes off the event loop
+                async def fetch_employees():
                     # Use cached employees if available
                     try:
-                        employees = get_cached_employees()
+                        employees = await get_cached_employees()
                     except:
                         employees = query("Employee")
                         
@@ -102,7 +104,7 @@ async def websocket_endpoint(websocket: WebSocket):
                 
                 # Run in thread pool and await completion
                 # employees_data = await asyncio.get_event_loop().run_in_executor(thread_pool, fetch_employees)
-                employees_data = fetch_employees()
+                employees_data = await fetch_employees()
                 await websocket.send_json({
                     "type": "employee_data",
                     "data": employees_data
@@ -169,6 +171,7 @@ async def websocket_endpoint(websocket: WebSocket):
                             
                             # Delete the employee
                             delete("Employee", object_id)
+                            invalidate_employee_cache()
                             
                             # Broadcast employee deletion
                             await broadcast_attendance_update({
@@ -211,6 +214,7 @@ async def websocket_endpoint(websocket: WebSocket):
                     employee = delete_employee_record()
                     
                     if employee:
+                        invalidate_employee_cache()
                         # Broadcast employee deletion
                         await broadcast_attendance_update({
                             "action": "delete_employee",
@@ -329,6 +333,7 @@ async def websocket_endpoint(websocket: WebSocket):
                     #     thread_pool, create_employee_record)
 
                     new_employee = create_employee_record()
+                    invalidate_employee_cache()
 
                     # Save the registration image
                     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
@@ -393,18 +398,23 @@ async def websocket_endpoint(websocket: WebSocket):
                     if "," in image_data:
                         image_data = image_data.split(",")[1]
 
-                    # Submit image processing to process pool (CPU intensive task)
+                    # Decode base64 to the compressed image bytes; the worker does the pixel decode
+                    image_bytes = base64.b64decode(image_data)
+
+                    # Submit image processing to process pool (CPU intensive task).
+                    # Only the compressed image and the shared employee matrix handle are sent.
                     process_pool = get_process_pool()
                     future = process_pool.submit(
                         process_image_in_process,
-                        image_data,
+                        image_bytes,
                         entry_type,
-                        client_id
+                        client_id,
+                        await get_employee_matrix_handle()
                     )
 
-                    # Store the future with client_id
+                    # Store the client_id keyed by the future's id for O(1) removal on completion
                     pending_futures = get_pending_futures()
-                    pending_futures[future] = client_id
+                    pending_futures[id(future)] = client_id
 
                     # Add callback for when the future completes
                     future.add_done_callback(
@@ -450,8 +460,8 @@ async def websocket_endpoint(websocket: WebSocket):
         
         # Clean up any pending futures for this client
         pending_futures = get_pending_futures()
-        for future, future_client_id in list(pending_futures.items()):
+        for future_id, future_client_id in list(pending_futures.items()):
             if future_client_id == client_id:
-                del pending_futures[future]
+                pending_futures.pop(future_id, None)
                 
         logger.info(f"WebSocket connection {client_id} closed. Total connections: {len(active_connections)}") 
\ No newline at end of file
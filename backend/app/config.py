@@ -6,6 +6,8 @@ PING_INTERVAL = 30  # seconds
 PING_TIMEOUT = 60  # seconds
 MAX_FRAMES_PER_SECOND = 1
 MAX_CONCURRENT_TASKS_PER_CLIENT = 2
+BROADCAST_BATCH_SIZE = 50  # clients per gather before yielding to the event loop
+EVENT_BATCH_SIZE = 50  # queued events drained per processing pass
 
 # Cache settings
 USER_CACHE_TTL = 300  # 5 minutes
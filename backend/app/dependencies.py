@@ -4,8 +4,16 @@ from app.face_utils import FaceRecognition
 from multiprocessing import Manager, cpu_count
 import concurrent.futures
 import multiprocessing
+import asyncio
+import threading
 import time
 import logging
+import cv2
+import numpy as np
+import orjson
+from threadpoolctl import threadpool_limits
+from multiprocessing import shared_memory
+from typing import NamedTuple
 from app.models import Employee
 
 logger = logging.getLogger(__name__)
@@ -17,8 +25,76 @@ THREAD_WORKERS = CPU_COUNT * 2  # More threads than CPUs for I/O bound tasks
 
 logger.info(f"System has {CPU_COUNT} CPUs, using {PROCESS_WORKERS} process workers and {THREAD_WORKERS} thread workers")
 
+class SharedEmployeeMatrix(NamedTuple):
+    """Location of the published employee matrix in shared memory.
+
+    The segment holds the (rows, dim) float32 L2-normalized embedding matrix followed by
+    metadata_nbytes of orjson-encoded employee records (without embeddings) in row order.
+    """
+    name: str
+    rows: int
+    dim: int
+    metadata_nbytes: int
+    version: int
+
+# Per-worker employee snapshot, populated by init_worker inside each process pool worker
+_worker_state = {}
+
+def init_worker():
+    """Process pool initializer: pin native thread pools to one thread, then map the
+    published employee matrix (or load it) once per worker"""
+    # PROCESS_WORKERS processes already run in parallel; per-process ONNX Runtime,
+    # OpenMP/BLAS and OpenCV pools sized to the CPU count would oversubscribe the cores.
+    # ORT sizes its pools when a session is created, so the inherited sessions are rebuilt.
+    threadpool_limits(limits=1)
+    cv2.setNumThreads(1)
+    try:
+        face_recognition.configure_sessions(intra_op_num_threads=1, inter_op_num_threads=1)
+    except Exception as e:
+        logger.error(f"Error configuring ONNX Runtime sessions in process worker: {str(e)}")
+    try:
+        get_worker_employee_matrix(employee_matrix_handle.value)
+    except Exception as e:
+        logger.error(f"Error loading employees in process worker: {str(e)}")
+
+def _set_worker_state(matrix, employees, version, shm=None):
+    old_shm = _worker_state.get("shm")
+    _worker_state.update(matrix=matrix, employees=employees, version=version, shm=shm)
+    if old_shm is not None:
+        try:
+            old_shm.close()
+        except BufferError:
+            # A view of the old segment is still referenced, it is released with it
+            pass
+
+def _load_worker_employees(version):
+    employees = Employee().query()
+    matrix, employees = face_recognition.get_stored_matrix(employees)
+    _set_worker_state(matrix, employees, version)
+
+def _attach_employee_matrix(handle: "SharedEmployeeMatrix"):
+    shm = shared_memory.SharedMemory(name=handle.name)
+    matrix = np.ndarray((handle.rows, handle.dim), dtype=np.float32, buffer=shm.buf)
+    matrix.flags.writeable = False
+    metadata = bytes(shm.buf[matrix.nbytes:matrix.nbytes + handle.metadata_nbytes])
+    _set_worker_state(matrix, orjson.loads(metadata), handle.version, shm)
+
+def get_worker_employee_matrix(handle: "SharedEmployeeMatrix" = None):
+    """Return the worker's (matrix, employees), re-mapping shared memory when the published version moved"""
+    if handle is not None:
+        if _worker_state.get("version") != handle.version:
+            try:
+                _attach_employee_matrix(handle)
+            except FileNotFoundError:
+                # Segment already released by the main process, fall back to the database
+                logger.warning(f"Shared employee matrix {handle.name} is gone, loading employees from database")
+                _load_worker_employees(handle.version)
+    elif "employees" not in _worker_state:
+        _load_worker_employees(None)
+    return _worker_state["matrix"], _worker_state["employees"]
+
 # Create a process pool for CPU-intensive tasks (face recognition)
-process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PROCESS_WORKERS)
+process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PROCESS_WORKERS, initializer=init_worker)
 
 # Create a thread pool for I/O bound tasks (database operations, network calls)
 thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=THREAD_WORKERS, thread_name_prefix="io_worker")
@@ -31,15 +107,37 @@ websocket_responses_queue = manager.Queue(maxsize=100)
 # Dictionary to store pending futures
 pending_futures = {}
 
-# Employee cache to avoid frequent database queries
-employee_cache = manager.dict()
-employee_cache_lock = manager.Lock()
-employee_cache_last_updated = manager.Value('d', 0)
+class CacheValue:
+    """Mutable holder for module-level cache state, keeps the `.value` interface of the old Manager Value"""
+    def __init__(self, value=None):
+        self.value = value
+
+# Employee cache to avoid frequent database queries.
+# Only the main process reads it, so plain in-process structures avoid Manager IPC.
+employee_cache = {}
+# Serializes refreshes so only one caller hits the database at a time
+employee_cache_lock = asyncio.Lock()
+employee_cache_last_updated = CacheValue(0.0)
+# Set while a background refresh is scheduled or running
+employee_cache_refreshing = CacheValue(False)
+# Strong reference to the background refresh task so it isn't garbage collected
+_employee_cache_refresh_task = CacheValue(None)
+# Bumped on every refresh so process workers know when their snapshot is stale
+employee_cache_version = CacheValue(0)
+# Bumped by invalidate_employee_cache so a refresh already in flight doesn't mark stale data fresh
+employee_cache_generation = CacheValue(0)
+# Handle of the shared memory segment holding the current employee matrix
+employee_matrix_handle = CacheValue(None)
+# Roster key of the published matrix, an unchanged roster is not republished
+_published_roster_key = CacheValue(None)
+# Published segments kept alive in the main process: the current one and the previous one,
+# so tasks submitted just before a refresh can still map it
+_shared_segments = []
 EMPLOYEE_CACHE_TTL = 300  # 5 minutes
 
 # Dictionary to track number of pending tasks per client
-client_pending_tasks = manager.dict()
-client_pending_tasks_lock = manager.Lock()
+client_pending_tasks = {}
+client_pending_tasks_lock = threading.Lock()
 
 # Store active WebSocket connections
 active_connections = {}
@@ -71,15 +169,94 @@ def get_client_tasks():
 def get_active_connections():
     return active_connections
 
-def get_cached_employees():
-    """Get employees from cache or database with TTL"""
-    current_time = time.time()
-    with employee_cache_lock:
-        if current_time - employee_cache_last_updated.value > EMPLOYEE_CACHE_TTL or not employee_cache:
-            # Update cache
-            employees = Employee().query()
+async def _refresh_employee_cache():
+    """Reload the employee cache from the database unless another caller just did"""
+    try:
+        async with employee_cache_lock:
+            if employee_cache_last_updated.value > 0 and time.time() - employee_cache_last_updated.value <= EMPLOYEE_CACHE_TTL:
+                return
+            generation = employee_cache_generation.value
+            # Run the blocking query on the I/O thread pool
+            employees = await asyncio.get_running_loop().run_in_executor(thread_pool, Employee().query)
             employee_cache.clear()
             employee_cache.update({employee["objectId"]: employee for employee in employees})
-            employee_cache_last_updated.value = current_time
+            if generation == employee_cache_generation.value:
+                employee_cache_last_updated.value = time.time()
+            roster_key = face_recognition.roster_key(employees)
+            if roster_key != _published_roster_key.value or employee_matrix_handle.value is None:
+                employee_cache_version.value += 1
+                # Stored embeddings may have changed, drop the normalized copies
+                face_recognition.invalidate_embedding_cache()
+                try:
+                    # Building and copying the matrix is CPU bound, keep it off the event loop
+                    handle, shm = await asyncio.get_running_loop().run_in_executor(
+                        thread_pool, _build_shared_employee_matrix, employees, employee_cache_version.value)
+                    _swap_employee_matrix(handle, shm)
+                    _published_roster_key.value = roster_key
+                except Exception as e:
+                    # Workers fall back to querying the database themselves
+                    logger.error(f"Error publishing employee matrix to shared memory: {str(e)}")
+                    employee_matrix_handle.value = None
+                    _published_roster_key.value = None
             logger.info("Employee cache updated")
-        return list(employee_cache.values()) 
\ No newline at end of file
+    finally:
+        employee_cache_refreshing.value = False
+
+async def get_cached_employees():
+    """Get employees from cache or database with TTL
+
+    On a cold or invalidated cache the caller waits for the database. Once the cache is populated a
+    stale entry is returned immediately while a single background task refreshes it.
+    """
+    # last_updated stays 0 until the first load and after an invalidation; an empty
+    # Employee table still counts as loaded
+    if not employee_cache_last_updated.value > 0:
+        await _refresh_employee_cache()
+    elif time.time() - employee_cache_last_updated.value > EMPLOYEE_CACHE_TTL and not employee_cache_refreshing.value:
+        employee_cache_refreshing.value = True
+        _employee_cache_refresh_task.value = asyncio.create_task(_refresh_employee_cache())
+    return list(employee_cache.values())
+
+def invalidate_employee_cache():
+    """Mark the employee cache stale after an Employee create/update/delete.
+
+    The next caller of get_cached_employees() waits for a fresh copy from the database,
+    which also publishes a new employee matrix version for the process workers.
+    """
+    employee_cache_generation.value += 1
+    employee_cache_last_updated.value = 0
+
+def _build_shared_employee_matrix(employees, version):
+    """Copy the normalized employee matrix and metadata into a new shared memory segment"""
+    matrix, users = face_recognition.get_stored_matrix(employees)
+    metadata = orjson.dumps([{key: value for key, value in user.items() if key != "embedding"} for user in users])
+    shm = shared_memory.SharedMemory(create=True, size=matrix.nbytes + len(metadata))
+    np.ndarray(matrix.shape, dtype=np.float32, buffer=shm.buf)[:] = matrix
+    shm.buf[matrix.nbytes:matrix.nbytes + len(metadata)] = metadata
+    return SharedEmployeeMatrix(shm.name, matrix.shape[0], matrix.shape[1], len(metadata), version), shm
+
+def _swap_employee_matrix(handle, shm):
+    """Publish a built segment and release the ones older than the previous version"""
+    employee_matrix_handle.value = handle
+    _shared_segments.append(shm)
+    while len(_shared_segments) > 2:
+        _release_segment(_shared_segments.pop(0))
+
+def _release_segment(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+def release_shared_employee_matrix():
+    """Unlink all published employee matrix segments (called on shutdown)"""
+    while _shared_segments:
+        _release_segment(_shared_segments.pop())
+    employee_matrix_handle.value = None
+    _published_roster_key.value = None
+
+async def get_employee_matrix_handle():
+    """Return the shared employee matrix handle, scheduling a refresh first if the cache is stale"""
+    await get_cached_employees()
+    return employee_matrix_handle.value
@@ -1,54 +1,161 @@
 import numpy as np
 import insightface
+import onnxruntime
 from insightface.app import FaceAnalysis
 import cv2
-import json
+import math
+import numba
+import base64
+import orjson
 import logging
-import concurrent.futures
 from typing import List, Dict, Any, Tuple
+from dataclasses import dataclass
 import threading
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Length of the buffalo_l (ArcFace) face embedding
+EMBEDDING_DIM = 512
+
+# Users compared per matmul block in find_matches_for_embeddings
+MATCH_BLOCK_SIZE = 256
+
+# Prefix marking int8-quantized embeddings: base64 of a float32 scale followed by int8 values
+INT8_EMBEDDING_PREFIX = "q8:"
+
+def embedding_to_str(embedding: np.ndarray) -> str:
+    """Encode an embedding as int8 with a symmetric per-vector scale, base64 for storage"""
+    embedding = np.asarray(embedding, dtype=np.float32)
+    max_abs = float(np.max(np.abs(embedding))) if embedding.size else 0.0
+    scale = np.float32(max_abs / 127 if max_abs > 0 else 1.0)
+    quantized = np.round(embedding / scale).astype(np.int8)
+    return INT8_EMBEDDING_PREFIX + base64.b64encode(scale.tobytes() + quantized.tobytes()).decode("ascii")
+
+def str_to_embedding(embedding_str: str) -> np.ndarray:
+    """Decode a stored embedding to float32, accepting the legacy float32, JSON and comma-separated formats"""
+    embedding_str = embedding_str.strip()
+    if embedding_str.startswith(INT8_EMBEDDING_PREFIX):
+        buf = base64.b64decode(embedding_str[len(INT8_EMBEDDING_PREFIX):], validate=True)
+        if len(buf) != 4 + EMBEDDING_DIM:
+            raise ValueError(f"int8 embedding buffer has {len(buf)} bytes, expected {4 + EMBEDDING_DIM}")
+        scale = np.frombuffer(buf, dtype=np.float32, count=1)[0]
+        return np.frombuffer(buf, dtype=np.int8, offset=4).astype(np.float32) * scale
+    if embedding_str.startswith("["):
+        # Legacy JSON list
+        return np.asarray(orjson.loads(embedding_str), dtype=np.float32)
+    if "," in embedding_str:
+        # Legacy comma-separated floats
+        return np.asarray(embedding_str.split(","), dtype=np.float32)
+    # Legacy raw float32 bytes
+    buf = base64.b64decode(embedding_str, validate=True)
+    if len(buf) != 4 * EMBEDDING_DIM:
+        raise ValueError(f"float32 embedding buffer has {len(buf)} bytes, expected {4 * EMBEDDING_DIM}")
+    return np.frombuffer(buf, dtype=np.float32)
+
+def is_legacy_embedding_str(embedding_str: str) -> bool:
+    """Check whether a stored embedding still uses a pre-int8 format"""
+    return not embedding_str.strip().startswith(INT8_EMBEDDING_PREFIX)
+
+@numba.njit(cache=True, fastmath=True)
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Cosine similarity of two 1-D float32 vectors in one fused loop, without temporary arrays"""
+    # njit does no bounds checking, mismatched lengths would read past b
+    if a.shape[0] != b.shape[0]:
+        return 0.0
+    dot = 0.0
+    norm_a = 0.0
+    norm_b = 0.0
+    for i in range(a.shape[0]):
+        dot += a[i] * b[i]
+        norm_a += a[i] * a[i]
+        norm_b += b[i] * b[i]
+    if norm_a == 0.0 or norm_b == 0.0:
+        return 0.0
+    return dot / math.sqrt(norm_a * norm_b)
+
+@dataclass
+class FaceEmbeddings:
+    """Embeddings and bounding boxes of all faces detected in one image"""
+    embeddings: np.ndarray  # (F, D) float32
+    bboxes: np.ndarray  # (F, 4) float32
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @classmethod
+    def empty(cls) -> "FaceEmbeddings":
+        return cls(np.empty((0, EMBEDDING_DIM), dtype=np.float32), np.empty((0, 4), dtype=np.float32))
+
 class FaceRecognition:
     def __init__(self):
         try:
-            logger.info("Initializing FaceRecognition with buffalo_l model")
-            self.app = FaceAnalysis(name='buffalo_l')
-            self.app.prepare(ctx_id=0, det_size=(640, 640))
+            # Prefer the CUDA execution provider when onnxruntime-gpu can use it
+            available_providers = onnxruntime.get_available_providers()
+            self.providers = [provider for provider in ('CUDAExecutionProvider', 'CPUExecutionProvider')
+                              if provider in available_providers]
+            use_gpu = 'CUDAExecutionProvider' in self.providers
+            logger.info(f"Initializing FaceRecognition with buffalo_l model on {'GPU' if use_gpu else 'CPU'}")
+            self.app = FaceAnalysis(name='buffalo_l', providers=self.providers)
+            self.app.prepare(ctx_id=0 if use_gpu else -1, det_size=(640, 640))
+            if not use_gpu:
+                # Process pool workers run inference in parallel, keep each session single-threaded
+                self.configure_sessions(intra_op_num_threads=1)
             self.threshold = 0.5 # Cosine similarity threshold for matching
-            # Create a thread pool for parallel processing
-            self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+            # Cached normalized matrix of stored embeddings, rebuilt when the roster changes
+            self._stored_cache_key = None
+            self._stored_matrix = None
+            self._stored_users = []
+            # Normalized float32 embeddings per user, keyed by objectId -> (updatedAt, embedding)
+            self._norm_cache: Dict[str, Tuple[Any, np.ndarray]] = {}
+            self._norm_cache_lock = threading.Lock()
             logger.info("FaceRecognition initialized successfully")
         except Exception as e:
             logger.error(f"Error initializing FaceRecognition: {str(e)}")
             raise
 
-    def get_embeddings(self, image):
-        """Extract face embeddings from image for all detected faces"""
+    def configure_sessions(self, intra_op_num_threads: int = 0, inter_op_num_threads: int = 0):
+        """Rebuild every model's ONNX Runtime session with the given thread counts (0 = ORT default)
+
+        insightface drops SessionOptions passed to FaceAnalysis and prepare() recreates the
+        sessions with defaults, so thread limits can only be applied by replacing the sessions.
+        """
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.intra_op_num_threads = intra_op_num_threads
+        sess_options.inter_op_num_threads = inter_op_num_threads
+        for name, model in self.app.models.items():
+            model.session = onnxruntime.InferenceSession(model.model_file, sess_options=sess_options, providers=self.providers)
+            applied = model.session.get_session_options()
+            if (applied.intra_op_num_threads, applied.inter_op_num_threads) != (intra_op_num_threads, inter_op_num_threads):
+                raise RuntimeError(f"ONNX Runtime session for {name} did not apply the requested thread counts")
+        logger.info(f"ONNX Runtime sessions use intra_op={intra_op_num_threads}, inter_op={inter_op_num_threads} threads")
+
+    def get_embeddings(self, image) -> FaceEmbeddings:
+        """Extract face embeddings and bounding boxes from image for all detected faces"""
         try:
-            logger.info("Detecting faces in image")
             faces = self.app.get(image)
             if not faces:
-                logger.warning("No faces detected in image")
-                return []
+                logger.debug("No faces detected in image")
+                return FaceEmbeddings.empty()
             
-            logger.info(f"Found {len(faces)} faces")
-            # Return only face embeddings
-            return [face.embedding for face in faces]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Found {len(faces)} faces")
+            # Stack into contiguous (F, D) and (F, 4) arrays for the matmul path
+            return FaceEmbeddings(
+                embeddings=np.array([face.embedding for face in faces], dtype=np.float32),
+                bboxes=np.array([face.bbox for face in faces], dtype=np.float32)
+            )
         except Exception as e:
             logger.error(f"Error extracting face embeddings: {str(e)}")
-            return []
+            return FaceEmbeddings.empty()
 
     def get_embedding(self, image):
         """Extract face embedding from image (legacy method for backward compatibility)"""
-        embeddings = self.get_embeddings(image)
-        if not embeddings:
+        faces = self.get_embeddings(image)
+        if not faces:
             return None
-        logger.info(f"Found {len(embeddings)} faces, using the first one")
-        return embeddings[0]  # Return just the embedding of the first face
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Found {len(faces)} faces, using the first one")
+        return faces.embeddings[0]  # Return just the embedding of the first face
 
     def compare_faces(self, embedding1, embedding2):
         """Compare two face embeddings using cosine similarity"""
@@ -56,12 +163,11 @@ class FaceRecognition:
             return 0.0  # Return 0 similarity for invalid embeddings
         
         try:
-            # Normalize the embeddings
-            embedding1_norm = embedding1 / np.linalg.norm(embedding1)
-            embedding2_norm = embedding2 / np.linalg.norm(embedding2)
-            
-            # Calculate cosine similarity
-            similarity = np.dot(embedding1_norm, embedding2_norm)
+            # Same dtype and layout for both operands so the JIT kernel is compiled once
+            similarity = cosine_similarity(
+                np.ascontiguousarray(embedding1, dtype=np.float32),
+                np.ascontiguousarray(embedding2, dtype=np.float32)
+            )
             
             # logger.info(f"Face comparison similarity: {similarity}")
             return similarity
@@ -72,7 +178,7 @@ class FaceRecognition:
     def embedding_to_str(self, embedding):
         """Convert numpy array to string for storage"""
         try:
-            return json.dumps(embedding.tolist())
+            return embedding_to_str(embedding)
         except Exception as e:
             logger.error(f"Error converting embedding to string: {str(e)}")
             raise
@@ -80,59 +186,129 @@ class FaceRecognition:
     def str_to_embedding(self, embedding_str):
         """Convert stored string back to numpy array"""
         try:
-            return np.array(json.loads(embedding_str))
+            return str_to_embedding(embedding_str)
         except Exception as e:
             logger.error(f"Error converting string to embedding: {str(e)}")
             raise
 
-    def find_match_for_user(self, query_embedding: np.ndarray, user: Any, threshold: float) -> Tuple[Any, float]:
-        """Find match for a single user (to be used in parallel)"""
-        try:
-            # Use dictionary access for user records from the database
-            stored_embedding = self.str_to_embedding(user.get("embedding"))
-            similarity = self.compare_faces(query_embedding, stored_embedding)
-            return user, similarity
-        except Exception as e:
-            logger.error(f"Error matching user: {str(e)}")
-            return user, 0.0
+    def get_normalized_embedding(self, user: Any) -> np.ndarray:
+        """Return the L2-normalized float32 embedding for a user, decoding it at most once"""
+        object_id = user.get("objectId")
+        updated_at = user.get("updatedAt")
+        with self._norm_cache_lock:
+            cached = self._norm_cache.get(object_id)
+        if cached is not None and cached[0] == updated_at:
+            return cached[1]
+
+        embedding = np.asarray(self.str_to_embedding(user.get("embedding")), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding = embedding / norm
+
+        if object_id is not None:
+            with self._norm_cache_lock:
+                self._norm_cache[object_id] = (updated_at, embedding)
+        return embedding
+
+    def invalidate_embedding_cache(self):
+        """Drop all cached normalized embeddings (called when the employee cache is refreshed)"""
+        with self._norm_cache_lock:
+            self._norm_cache.clear()
+        self._stored_cache_key = None
+        self._stored_matrix = None
+        self._stored_users = []
+
+    @staticmethod
+    def roster_key(users: List[Any]) -> Tuple[Tuple[Any, Any], ...]:
+        """Identify a roster by its (objectId, updatedAt) pairs"""
+        return tuple((user.get("objectId"), user.get("updatedAt")) for user in users)
+
+    def get_stored_matrix(self, users: List[Any]) -> Tuple[np.ndarray, List[Any]]:
+        """Return the L2-normalized (U, D) float32 matrix of stored embeddings for users.
+
+        The matrix is rebuilt only when the roster (objectId/updatedAt pairs) changes.
+        """
+        cache_key = self.roster_key(users)
+        if cache_key == self._stored_cache_key and self._stored_matrix is not None:
+            return self._stored_matrix, self._stored_users
 
-    def find_matches_for_embeddings(self, query_embeddings: List[np.ndarray], users: List[Any], threshold: float = None) -> List[Dict[str, Any]]:
-        """Find matches for multiple face embeddings using parallel processing"""
+        rows = []
+        valid_users = []
+        for user in users:
+            try:
+                embedding = self.get_normalized_embedding(user)
+                if embedding.shape != (EMBEDDING_DIM,):
+                    raise ValueError(f"expected embedding of shape ({EMBEDDING_DIM},), got {embedding.shape}")
+                rows.append(embedding)
+                valid_users.append(user)
+            except Exception as e:
+                logger.error(f"Error loading embedding for user {user.get('objectId')}: {str(e)}")
+
+        if rows:
+            # Rows come from the per-user cache already normalized
+            stored_matrix = np.ascontiguousarray(np.stack(rows), dtype=np.float32)
+        else:
+            stored_matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+        self._stored_cache_key = cache_key
+        self._stored_matrix = stored_matrix
+        self._stored_users = valid_users
+        return stored_matrix, valid_users
+
+    def find_matches_for_embeddings(self, query_embeddings: np.ndarray, users: List[Any], threshold: float = None,
+                                    early_exit_threshold: float = 0.8) -> List[Dict[str, Any]]:
+        """Find matches for an (F, D) matrix (or list) of face embeddings with blocked similarity matmuls
+
+        The roster is scanned in blocks of MATCH_BLOCK_SIZE users; once every face has a
+        match at or above early_exit_threshold the remaining blocks are skipped.
+        Pass early_exit_threshold=None to always scan the whole roster.
+        """
+        if len(query_embeddings) == 0 or not users:
+            return []
+
+        stored_matrix, stored_users = self.get_stored_matrix(users)
+        return self.find_matches_in_matrix(query_embeddings, stored_matrix, stored_users, threshold, early_exit_threshold)
+
+    def find_matches_in_matrix(self, query_embeddings: np.ndarray, stored_matrix: np.ndarray, stored_users: List[Any],
+                               threshold: float = None, early_exit_threshold: float = 0.8) -> List[Dict[str, Any]]:
+        """Match face embeddings against an already L2-normalized (U, D) matrix whose rows line up with stored_users"""
         if threshold is None:
             threshold = self.threshold
-            
+
         matches = []
-        
-        for query_embedding in query_embeddings:
-            # Submit all user comparisons to thread pool
-            futures = []
-            for user in users:
-                future = self.thread_pool.submit(
-                    self.find_match_for_user,
-                    query_embedding,
-                    user,
-                    threshold
-                )
-                futures.append(future)
-            
-            # Get results and find best match
-            best_match = None
-            best_similarity = 0.0
-            
-            for future in concurrent.futures.as_completed(futures):
-                user, similarity = future.result()
-                if similarity > best_similarity:
-                    best_similarity = similarity
-                    best_match = user
-            
-            if best_similarity >= threshold and best_match:
+        if len(query_embeddings) == 0 or not stored_users:
+            return matches
+
+        # Copy and normalize all query embeddings in one shot
+        query_matrix = np.array(query_embeddings, dtype=np.float32)
+        query_norms = np.linalg.norm(query_matrix, axis=1, keepdims=True)
+        query_norms[query_norms == 0] = 1.0
+        query_matrix /= query_norms
+
+        query_count = query_matrix.shape[0]
+        rows = np.arange(query_count)
+        best = np.zeros(query_count, dtype=np.intp)
+        best_similarities = np.full(query_count, -np.inf, dtype=np.float32)
+
+        for start in range(0, len(stored_users), MATCH_BLOCK_SIZE):
+            # (Q, D) @ (D, B) -> (Q, B) cosine similarities for this block of users
+            similarities = query_matrix @ stored_matrix[start:start + MATCH_BLOCK_SIZE].T
+            block_best = similarities.argmax(axis=1)
+            block_similarities = similarities[rows, block_best]
+
+            improved = block_similarities > best_similarities
+            best[improved] = block_best[improved] + start
+            best_similarities[improved] = block_similarities[improved]
+
+            # Every face already has a high-confidence match, skip the rest of the roster
+            if early_exit_threshold is not None and (best_similarities >= early_exit_threshold).all():
+                break
+
+        for index, similarity in zip(best, best_similarities):
+            if similarity >= threshold:
                 matches.append({
-                    'employee': best_match,
-                    'similarity': best_similarity
+                    'employee': stored_users[index],
+                    'similarity': float(similarity)
                 })
-                
-        return matches
 
-    def __del__(self):
-        """Clean up thread pool when object is destroyed"""
-        self.thread_pool.shutdown(wait=True) 
\ No newline at end of file
+        return matches
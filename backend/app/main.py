@@ -2,8 +2,8 @@ from fastapi import FastAPI
 from . import create_app
 from .api import router as api_router
 from .api.routes import attendance, employees, office_timings, timezone, websocket
-from .utils.websocket import process_queue, process_websocket_responses
-from .dependencies import process_pool
+from .utils.websocket import process_events, start_queue_bridges
+from .dependencies import process_pool, release_shared_employee_matrix
 from .database import query, create, create_class_schema
 from .utils.time_utils import get_local_time
 import asyncio
@@ -147,9 +147,9 @@ async def startup_event():
     """Initialize the application on startup"""
     # this is always commented out
     # initialize_back4app()
-    # Start the WebSocket response processing tasks
-    asyncio.create_task(process_queue())
-    asyncio.create_task(process_websocket_responses())
+    # Feed the manager queues into asyncio queues, then start the processing tasks
+    start_queue_bridges()
+    asyncio.create_task(process_events())
     logger.info("Application startup completed")
 
 
@@ -157,4 +157,5 @@ async def startup_event():
 async def shutdown_event():
     """Clean up resources on shutdown"""
     process_pool.shutdown()
+    release_shared_employee_matrix()
     logger.info("Application shutdown completed")
@@ -0,0 +1,25 @@
+from app.database import query, update
+from app.face_utils import embedding_to_str, str_to_embedding, is_legacy_embedding_str
+
+def migrate_embeddings():
+    """Re-encode legacy employee embeddings in the int8-quantized storage format"""
+    print("Migrating employee embeddings...")
+
+    employees = query("Employee", limit=1000)
+    migrated = 0
+    for employee in employees:
+        embedding_str = employee.get("embedding")
+        if not embedding_str or not is_legacy_embedding_str(embedding_str):
+            continue
+        try:
+            embedding = str_to_embedding(embedding_str)
+            update("Employee", employee["objectId"], {"embedding": embedding_to_str(embedding)})
+            migrated += 1
+            print(f"- Migrated {employee.get('employee_id')} ({employee.get('name')})")
+        except Exception as e:
+            print(f"Error migrating {employee.get('employee_id')}: {str(e)}")
+
+    print(f"\nMigrated {migrated} of {len(employees)} employees")
+
+if __name__ == "__main__":
+    migrate_embeddings()
@@ -1,9 +1,8 @@
 import cv2
 import numpy as np
-import base64
 import logging
 from typing import List, Dict, Any
-from ..dependencies import get_face_recognition
+from ..dependencies import get_face_recognition, get_worker_employee_matrix, SharedEmployeeMatrix
 from ..models import Employee, Attendance, Shift
 from ..utils.time_utils import get_local_date, get_local_time, convert_to_local_time
 from datetime import datetime, timedelta
@@ -269,18 +268,17 @@ def process_attendance_for_employee(employee: Dict[str, Any], similarity: float,
 
     return result
 
-def process_image_in_process(image_data: str, entry_type: str, client_id: str):
-    """Process image in a separate process - enhanced for real-time streaming with confidence information"""
-    try:
-        # image_data should already have the data URL prefix removed in the websocket endpoint
-        # But let's double-check
-        if "," in image_data:
-            image_data = image_data.split(",")[1]
-
-        # Decode base64 to bytes
-        image_bytes = base64.b64decode(image_data)
+def process_image_in_process(image_bytes: bytes, entry_type: str, client_id: str, employee_matrix: SharedEmployeeMatrix = None):
+    """Process image in a separate process - enhanced for real-time streaming with confidence information
 
-        # Convert to numpy array
+    image_bytes is the compressed (JPEG/PNG) image as sent by the client; it is only
+    decoded here, so the smallest representation crosses the process boundary.
+    employee_matrix points at the employee matrix the main process published in shared
+    memory; the worker maps it once per version. When omitted the employees are
+    queried from the database.
+    """
+    try:
+        # Decode the compressed image once, inside the worker
         nparr = np.frombuffer(image_bytes, np.uint8)
         img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
@@ -292,20 +290,27 @@ def process_image_in_process(image_data: str, entry_type: str, client_id: str):
         face_recognition = get_face_recognition()
         face_embeddings = face_recognition.get_embeddings(img)
         if not face_embeddings:
-            logger.info(f"No faces detected in image from client {client_id}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"No faces detected in image from client {client_id}")
             return [], [], {}, 1
 
-        # Get all employees from the database
-        employees = db_query("Employee")
-        if not employees:
-            logger.warning("No employees found in database")
-            return [], [], {}, 0
-
-        # Find matches for all detected faces
-        matches = face_recognition.find_matches_for_embeddings(face_embeddings, employees)
+        # Use the shared employee matrix, or the database when none was published
+        if employee_matrix is None:
+            employees = db_query("Employee")
+            if not employees:
+                logger.warning("No employees found in database")
+                return [], [], {}, 0
+            matches = face_recognition.find_matches_for_embeddings(face_embeddings.embeddings, employees)
+        else:
+            stored_matrix, employees = get_worker_employee_matrix(employee_matrix)
+            if not employees:
+                logger.warning("No employees found in database")
+                return [], [], {}, 0
+            matches = face_recognition.find_matches_in_matrix(face_embeddings.embeddings, stored_matrix, employees)
 
         if not matches:
-            logger.info(f"No matching employees found for client {client_id}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"No matching employees found for client {client_id}")
             return [], [], {}, 0
 
         # Process each matched employee
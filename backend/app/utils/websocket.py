@@ -1,21 +1,65 @@
 import asyncio
 import logging
-import concurrent.futures
-from typing import Dict, Any
+import orjson
+import threading
+from typing import Dict, Any, List, Union
 from fastapi import WebSocket
 from ..dependencies import get_active_connections, get_queues, get_client_tasks, get_pending_futures
 from ..utils.time_utils import get_local_time
+from ..config import BROADCAST_BATCH_SIZE, EVENT_BATCH_SIZE
 
 logger = logging.getLogger(__name__)
 
-# Create a thread pool executor for I/O operations
-thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+# Sources tagged onto items in the event queue
+PROCESSING_RESULTS = "processing_results"
+WEBSOCKET_RESPONSES = "websocket_responses"
+
+# asyncio queue fed from both manager queues by start_queue_bridges, items are (source, item)
+_event_queue = None
+
+def _bridge_queue(source_queue, source: str, target_queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+    """Forward items from a blocking manager queue into the asyncio event queue (runs in a daemon thread)"""
+    while True:
+        try:
+            item = source_queue.get()
+        except (EOFError, OSError):
+            # Manager process has shut down
+            logger.info("Queue bridge stopped")
+            return
+        except Exception as e:
+            logger.error(f"Error reading from queue bridge: {str(e)}")
+            continue
+        source_queue.task_done()
+        loop.call_soon_threadsafe(target_queue.put_nowait, (source, item))
+
+def start_queue_bridges():
+    """Create the event queue and start the threads feeding it; call from the running event loop"""
+    global _event_queue
+    loop = asyncio.get_running_loop()
+    _event_queue = asyncio.Queue()
+    processing_results_queue, websocket_responses_queue = get_queues()
+    for source_queue, source in ((processing_results_queue, PROCESSING_RESULTS),
+                                 (websocket_responses_queue, WEBSOCKET_RESPONSES)):
+        threading.Thread(
+            target=_bridge_queue,
+            args=(source_queue, source, _event_queue, loop),
+            name="queue_bridge",
+            daemon=True
+        ).start()
+    logger.info("Queue bridges started")
+
+def get_event_queue():
+    return _event_queue
+
+def _encode_message(message: Dict[str, Any]) -> str:
+    """Encode a message as compact JSON text with orjson"""
+    return orjson.dumps(message, option=orjson.OPT_SERIALIZE_NUMPY).decode()
 
 async def _send_message_to_client(websocket: WebSocket, message: Dict[str, Any], client_id: str = None) -> bool:
     """Send message to a client and return success status"""
     try:
-        # Use the event loop to run the send operation directly
-        await websocket.send_json(message)
+        # WebSocket sends are native coroutines, await them directly on the event loop
+        await websocket.send_text(_encode_message(message))
         if client_id:
             logger.debug(f"Successfully sent message to client {client_id}: {message.get('type', 'unknown')}")
         return True
@@ -24,18 +68,29 @@ async def _send_message_to_client(websocket: WebSocket, message: Dict[str, Any],
             logger.error(f"Error sending message to client {client_id}: {str(e)}")
         return False
 
-async def broadcast_attendance_update(attendance_data: Dict[str, Any]):
-    """Broadcast attendance updates to all connected clients"""
+async def _send_text_to_client(websocket: WebSocket, payload: str, client_id: str = None) -> bool:
+    """Send a pre-encoded JSON payload to a client and return success status"""
+    try:
+        await websocket.send_text(payload)
+        return True
+    except Exception as e:
+        if client_id:
+            logger.error(f"Error sending message to client {client_id}: {str(e)}")
+        return False
+
+async def broadcast_attendance_update(attendance_data: Union[Dict[str, Any], List[Dict[str, Any]]]):
+    """Broadcast one attendance update, or a list of them as a single frame, to all connected clients"""
     active_connections = get_active_connections()
     if not active_connections:
         logger.info("No active connections to broadcast to")
         return
 
     # Ensure objectId is included if this is a deletion
-    if attendance_data.get("action") == "delete" and "objectId" not in attendance_data:
-        logger.warning("Missing objectId in delete attendance update")
-        if "attendance_id" in attendance_data:
-            attendance_data["objectId"] = attendance_data["attendance_id"]
+    for update in (attendance_data if isinstance(attendance_data, list) else [attendance_data]):
+        if update.get("action") == "delete" and "objectId" not in update:
+            logger.warning("Missing objectId in delete attendance update")
+            if "attendance_id" in update:
+                update["objectId"] = update["attendance_id"]
 
     # Create a message with the attendance update
     message = {
@@ -46,17 +101,26 @@ async def broadcast_attendance_update(attendance_data: Dict[str, Any]):
     # Log the broadcast
     logger.info(f"Broadcasting attendance update to {len(active_connections)} clients: {attendance_data}")
 
-    # Send to all connected clients using gather to process in parallel
-    send_tasks = []
-    for client_id, websocket in active_connections.items():
-        send_tasks.append(_send_message_to_client(websocket, message, client_id))
-    
-    # Wait for all tasks to complete and get results
-    results = await asyncio.gather(*send_tasks, return_exceptions=True)
-    
+    # Serialize once for all clients
+    payload = _encode_message(message)
+
+    # Snapshot the connections so results line up with client ids
+    clients = list(active_connections.items())
+
+    # Send in batches, yielding to the event loop between them so large fan-outs don't stall other tasks
+    results = []
+    for start in range(0, len(clients), BROADCAST_BATCH_SIZE):
+        batch = clients[start:start + BROADCAST_BATCH_SIZE]
+        results.extend(await asyncio.gather(
+            *(_send_text_to_client(websocket, payload, client_id) for client_id, websocket in batch),
+            return_exceptions=True
+        ))
+        if start + BROADCAST_BATCH_SIZE < len(clients):
+            await asyncio.sleep(0)
+
     # Remove any disconnected clients
-    disconnected_clients = [client_id for i, client_id in enumerate(active_connections.keys()) 
-                           if isinstance(results[i], Exception) or results[i] is False]
+    disconnected_clients = [client_id for (client_id, _), result in zip(clients, results)
+                           if isinstance(result, Exception) or result is False]
     
     for client_id in disconnected_clients:
         if client_id in active_connections:
@@ -85,155 +149,137 @@ async def ping_client(websocket: WebSocket):
     except Exception as e:
         logger.error(f"Ping task error: {str(e)}")
 
-async def process_queue():
-    """Process the queue and broadcast updates to all connected clients"""
-    processing_results_queue, _ = get_queues()
+async def process_events():
+    """Process queued results and client responses, coalescing attendance updates into one broadcast per batch"""
+    event_queue = get_event_queue()
     while True:
-        try:
-            # Check if there are any items in the queue
-            if not processing_results_queue.empty():
-                # Get the next item from the queue
-                item = processing_results_queue.get()
-
-                # Process the item based on its type
-                if item.get("type") == "attendance_update":
-                    # Broadcast the attendance update
-                    await broadcast_attendance_update(item.get("data", []))
+        # Wait for the next event without polling, then drain whatever else is already queued
+        events = [await event_queue.get()]
+        while len(events) < EVENT_BATCH_SIZE:
+            try:
+                events.append(event_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
 
-                # Mark the task as done
-                processing_results_queue.task_done()
+        attendance_updates = []
+        for source, item in events:
+            try:
+                if source == PROCESSING_RESULTS:
+                    if item.get("type") == "attendance_update":
+                        data = item.get("data", [])
+                        attendance_updates.extend(data if isinstance(data, list) else [data])
+                else:
+                    await _handle_websocket_response(item)
+            except Exception as e:
+                logger.error(f"Error processing {source} event: {str(e)}")
+            finally:
+                event_queue.task_done()
 
-            # Sleep for a short time to avoid busy waiting
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error processing queue: {str(e)}")
-            # Sleep for a longer time if there was an error
-            await asyncio.sleep(1)
+        # One broadcast for every attendance update in the batch
+        if attendance_updates:
+            try:
+                await broadcast_attendance_update(attendance_updates)
+            except Exception as e:
+                logger.error(f"Error broadcasting attendance updates: {str(e)}")
 
-async def process_websocket_responses():
-    """Process the websocket responses queue and send responses to clients"""
-    _, websocket_responses_queue = get_queues()
+async def _handle_websocket_response(item: Dict[str, Any]):
+    """Send a processing response to the client it belongs to"""
     active_connections = get_active_connections()
-    
-    while True:
-        try:
-            # Check if there are any items in the queue
-            if not websocket_responses_queue.empty():
-                # Get the next item from the queue
-                item = websocket_responses_queue.get()
-                client_id = item["client_id"]
-
-                # Check if the client is still connected
-                if client_id not in active_connections:
-                    logger.info(f"Skipping response to disconnected client {client_id}")
-                    websocket_responses_queue.task_done()
-                    continue
+    client_id = item["client_id"]
 
-                websocket = active_connections[client_id]
-                
-                # Handle real-time detection messages
-                if item.get("type") == "real_time_detection":
-                    logger.info(f"Sending real-time detection to client {client_id}: {item.get('name', 'Unknown')} - {item.get('confidence_str', '0%')}")
-                    await _send_message_to_client(websocket, item, client_id)
-                    websocket_responses_queue.task_done()
-                    continue
-                
-                # Handle notification messages
-                if item.get("type") == "notification":
-                    await _send_message_to_client(
-                        websocket,
-                        {
-                            "type": "notification",
-                            "notification_type": item.get("notification_type", "info"),
-                            "message": item.get("message", "")
-                        },
-                        client_id
-                    )
-                    websocket_responses_queue.task_done()
-                    continue
-
-                # Check if this is an error response
-                if "error" in item:
-                    success = await _send_message_to_client(
-                        websocket, 
-                        {"status": "processing_error", "message": item["error"]},
-                        client_id
-                    )
-                    # Send notification for error
-                    await send_notification(websocket, f"Error processing: {item['error']}", "error", client_id)
-                    if not success and client_id in active_connections:
-                        del active_connections[client_id]
-                    websocket_responses_queue.task_done()
-                    continue
+    # Check if the client is still connected
+    if client_id not in active_connections:
+        logger.info(f"Skipping response to disconnected client {client_id}")
+        return
 
-                # Process the results
-                processed_users = item["processed_users"]
-                attendance_updates = item["attendance_updates"]
+    websocket = active_connections[client_id]
+    
+    # Handle real-time detection messages
+    if item.get("type") == "real_time_detection":
+        logger.info(f"Sending real-time detection to client {client_id}: {item.get('name', 'Unknown')} - {item.get('confidence_str', '0%')}")
+        await _send_message_to_client(websocket, item, client_id)
+        return
+    
+    # Handle notification messages
+    if item.get("type") == "notification":
+        await _send_message_to_client(
+            websocket,
+            {
+                "type": "notification",
+                "notification_type": item.get("notification_type", "info"),
+                "message": item.get("message", "")
+            },
+            client_id
+        )
+        return
 
-                if not processed_users:
-                    if item["no_face_count"] > 0:
-                        # No face detected
-                        success = await _send_message_to_client(
-                            websocket,
-                            {"status": "no_face_detected"},
-                            client_id
-                        )
-                        # Send notification for no face detected
-                        await send_notification(websocket, "No face detected in the image", "warning", client_id)
-                        if not success and client_id in active_connections:
-                            del active_connections[client_id]
-                    else:
-                        # No matching users found
-                        success = await _send_message_to_client(
-                            websocket,
-                            {"status": "no_matching_users"},
-                            client_id
-                        )
-                        # Send notification for no matching users
-                        await send_notification(websocket, "No matching users found", "warning", client_id)
-                        if not success and client_id in active_connections:
-                            del active_connections[client_id]
-                else:
-                    # Send response with all processed users to the current client
-                    success = await _send_message_to_client(
-                        websocket,
-                        {
-                            "type": "detection_result",
-                            "multiple_users": len(processed_users) > 1,
-                            "users": processed_users,
-                            "timestamp": get_local_time().isoformat()
-                        },
-                        client_id
-                    )
-                    
-                    # Send individual notifications for successful face detections
-                    # (This is a backup - real-time notifications should have already been sent in handle_future_completion)
-                    for user in processed_users:
-                        confidence = user.get('similarity', 0)
-                        # Format confidence as percentage
-                        confidence_str = f"{user.get('similarity_percent', confidence)}%"
-                        
-                        notification_msg = f"Detected: {user.get('name', 'Unknown')} (ID: {user.get('employee_id', 'Unknown')}) - Confidence: {confidence_str}"
-                        status_type = "success" if confidence >= 0.7 else "warning"  # Warning for lower confidence matches
-                        await send_notification(websocket, notification_msg, status_type, client_id)
-                    
-                    if not success and client_id in active_connections:
-                        del active_connections[client_id]
+    # Check if this is an error response
+    if "error" in item:
+        success = await _send_message_to_client(
+            websocket, 
+            {"status": "processing_error", "message": item["error"]},
+            client_id
+        )
+        # Send notification for error
+        await send_notification(websocket, f"Error processing: {item['error']}", "error", client_id)
+        if not success and client_id in active_connections:
+            del active_connections[client_id]
+        return
 
-                    # Add attendance updates to the queue for broadcasting
-                    if attendance_updates:
-                        for update in attendance_updates:
-                            await broadcast_attendance_update(update)
+    # Process the results
+    processed_users = item["processed_users"]
 
-                # Mark the task as done
-                websocket_responses_queue.task_done()
+    if not processed_users:
+        if item["no_face_count"] > 0:
+            # No face detected
+            success = await _send_message_to_client(
+                websocket,
+                {"status": "no_face_detected"},
+                client_id
+            )
+            # Send notification for no face detected
+            await send_notification(websocket, "No face detected in the image", "warning", client_id)
+            if not success and client_id in active_connections:
+                del active_connections[client_id]
+        else:
+            # No matching users found
+            success = await _send_message_to_client(
+                websocket,
+                {"status": "no_matching_users"},
+                client_id
+            )
+            # Send notification for no matching users
+            await send_notification(websocket, "No matching users found", "warning", client_id)
+            if not success and client_id in active_connections:
+                del active_connections[client_id]
+    else:
+        # Send response with all processed users to the current client
+        success = await _send_message_to_client(
+            websocket,
+            {
+                "type": "detection_result",
+                "multiple_users": len(processed_users) > 1,
+                "users": processed_users,
+                "timestamp": get_local_time().isoformat()
+            },
+            client_id
+        )
+        
+        # Send individual notifications for successful face detections
+        # (This is a backup - real-time notifications should have already been sent in handle_future_completion)
+        for user in processed_users:
+            confidence = user.get('similarity', 0)
+            # Format confidence as percentage
+            confidence_str = f"{user.get('similarity_percent', confidence)}%"
+            
+            notification_msg = f"Detected: {user.get('name', 'Unknown')} (ID: {user.get('employee_id', 'Unknown')}) - Confidence: {confidence_str}"
+            status_type = "success" if confidence >= 0.7 else "warning"  # Warning for lower confidence matches
+            await send_notification(websocket, notification_msg, status_type, client_id)
+        
+        if not success and client_id in active_connections:
+            del active_connections[client_id]
 
-            # Sleep for a short time to avoid busy waiting
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error processing websocket responses: {str(e)}")
-            # Sleep for a longer time if there was an error
-            await asyncio.sleep(1)
+        # Attendance updates are broadcast from the processing results queue by process_events
 
 def handle_future_completion(future, client_id):
     """Handle the completion of a future from the process pool"""
@@ -368,13 +414,5 @@ def handle_future_completion(future, client_id):
                 client_pending_tasks[client_id] = max(0, client_pending_tasks[client_id] - 1)
                 logger.info(f"Decreased pending tasks for client {client_id} to {client_pending_tasks[client_id]}")
         
-        # Remove future from pending futures
-        if future in pending_futures:
-            del pending_futures[future]
-
-# Function to gracefully shutdown the thread pool
-async def shutdown_thread_pool():
-    """Shutdown the thread pool gracefully"""
-    logger.info("Shutting down WebSocket thread pool")
-    thread_pool.shutdown(wait=True)
-    logger.info("WebSocket thread pool shutdown complete") 
\ No newline at end of file
+        # Remove future from pending futures (pop is a single atomic dict operation)
+        pending_futures.pop(id(future), None)